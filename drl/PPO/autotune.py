@@ -0,0 +1,252 @@
+"""Throughput autotuner
+
+Runs short training trials on the fake or the real environment and writes
+a machine-specific profile (minibatch size, TMAX, thread counts) that driver.py loads at startup.
+
+Inter-op threads can only be set once per process, so every inter-op candidate
+is tried in its own worker process, which sweeps the rest.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, SUPPRESS
+
+NUM_CONSEQ_FRAMES = 6
+EPOCHS = 100                    # epochs per training iteration, as in driver.py
+BATCH_SIZE = 128                # minibatch size, as in driver.py
+TMAX = 512                      # rollout length, as in driver.py
+BATCH_SIZES = [64, 128, 256, 512]
+TMAXS = [256, 512, 1024, 2048]
+TRIAL_STEPS = 32                # rollout steps to time collector thread counts
+TRIAL_UPDATES = 10              # learning steps to time each minibatch size
+BATCH_TOLERANCE = 1.1           # a larger minibatch is taken if its gradient step costs at most this much more
+MEMORY_BUDGET_GB = 8.
+ACTIVATION_FACTOR = 4           # rough activation memory of a minibatch, in multiples of its input
+ROLLOUT_COPIES = 4              # states and next states, each held as per-step list and torch.cat copy in finish_rollout()
+
+PROFILE_DIR = os.path.join(os.path.split(os.path.split(os.path.abspath(__file__))[0])[0], "profiles")
+
+def profile_path():
+    return os.path.join(PROFILE_DIR, f"{platform.node()}.json")
+
+def load_profile(path=None):
+    '''
+    Profile written by autotune for this machine, empty if there is none
+    '''
+    path = path or profile_path()
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+def save_profile(profile, path=None):
+    path = path or profile_path()
+    os.makedirs(os.path.split(path)[0], exist_ok=True)
+
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=2)
+
+def thread_candidates():
+    cpus = os.cpu_count() or 1
+    candidates = [t for t in [1, 2, 4, 8, 16, 32] if t < cpus]
+    return candidates + [cpus]
+
+def memory_estimate(state_size, num_agents, tmax, batch_size):
+    '''
+    Peak bytes held by a rollout (states and next states dominate, see ROLLOUT_COPIES) plus a training minibatch
+    '''
+    state_bytes = 4
+    for d in state_size:
+        state_bytes *= d
+
+    return ROLLOUT_COPIES * tmax * num_agents * state_bytes + ACTIVATION_FACTOR * batch_size * state_bytes
+
+class NullTracker:
+
+    def track(self, param_name, value, iter_index):
+        pass
+
+def make_env(args):
+    '''
+    Returns:
+    env, number of agents, action size, stacked visual observation size (C, H, W)
+    '''
+    if not args.fake:
+        from eval import open_env
+        return open_env(train_mode=True)
+
+    from fake_env import FakeUnityEnvironment
+
+    env = FakeUnityEnvironment(num_agents=args.agents, step_latency=args.step_latency)
+    h, w, c = env.obs_size
+    return env, args.agents, env.brains[env.brain_names[0]].vector_action_space_size[0], [c * NUM_CONSEQ_FRAMES, h, w]
+
+def run_trials(args):
+    '''
+    Worker: sweep collector and learner threads for one inter-op thread count,
+    and with args.hyperparams minibatch size and TMAX too
+
+    Returns:
+    best configuration with its measured throughput
+    '''
+    import torch
+    torch.set_num_interop_threads(args.interop)
+
+    import copy
+    from model import ActorCritic
+    from agent import PPOAgent
+    from trajectories import TrajectoryCollector, device
+
+    env, num_agents, action_size, state_size = make_env(args)
+    policy = ActorCritic(state_size, action_size).to(device)
+    budget = args.memory_gb * 1024 ** 3
+
+    # warm up: the first rollout pays for lazy initialization, keep it out of the first candidate's time
+    TrajectoryCollector(env, policy, num_agents, tmax=TRIAL_STEPS, is_visual=True, visual_state_size=NUM_CONSEQ_FRAMES).create_trajectories()
+
+    # collector threads: time a short rollout for each. Collection time is linear in TMAX,
+    # so the per-step time is all the end to end estimate needs
+    collect_step = {}
+    for threads in thread_candidates():
+        torch.set_num_threads(threads)
+        collector = TrajectoryCollector(env, policy, num_agents, tmax=TRIAL_STEPS, is_visual=True, visual_state_size=NUM_CONSEQ_FRAMES)
+
+        start = time.perf_counter()
+        collector.create_trajectories()
+        collect_step[threads] = (time.perf_counter() - start) / TRIAL_STEPS
+        print(f"collector threads {threads}: {num_agents / collect_step[threads]:.1f} samples/sec", file=sys.stderr)
+
+    env.close()
+
+    collector_threads = min(collect_step, key=collect_step.get)
+    torch.set_num_threads(collector_threads)
+
+    # minibatch size and TMAX change the PPO update: they are only tuned on request
+    batch_sizes = [BATCH_SIZE]
+    if args.hyperparams:
+        batch_sizes = [b for b in args.batch_sizes if memory_estimate(state_size, num_agents, min(args.tmax), b) <= budget]
+        if len(batch_sizes) == 0:
+            raise ValueError(f"no minibatch size fits in {args.memory_gb} GB")
+
+    # learner threads x minibatch size: update time does not depend on the values, random samples do
+    n_max = max(batch_sizes)
+    samples = {
+        "log_probs": torch.randn(n_max, device=device),
+        "states": torch.rand(n_max, *state_size, device=device),
+        "actions": torch.randn(n_max, action_size, device=device),
+        "advantages": torch.randn(n_max, device=device),
+        "returns": torch.randn(n_max, device=device)
+    }
+    traj_attributes = ["log_probs", "states", "actions", "advantages", "returns"]
+    update_time = {}
+    for threads in thread_candidates():
+        torch.set_num_threads(threads)
+        for batch_size in batch_sizes:
+            agent = PPOAgent(copy.deepcopy(policy), NullTracker(), 1e-4, 0.1, 0.01)
+            params = [samples[k][:batch_size] for k in traj_attributes]
+
+            # warm up
+            agent.learn(*params)
+
+            start = time.perf_counter()
+            for _ in range(TRIAL_UPDATES):
+                agent.learn(*params)
+            update_time[(batch_size, threads)] = (time.perf_counter() - start) / TRIAL_UPDATES
+
+            print(f"batch {batch_size}, learner threads {threads}: {1 / update_time[(batch_size, threads)]:.1f} updates/sec", file=sys.stderr)
+
+    # minibatch size: compared per gradient step, not per sample, which would always favour the largest.
+    # The largest one whose step costs about as much as the cheapest
+    def step_time(batch_size):
+        return min(update_time[(batch_size, threads)] for threads in thread_candidates())
+
+    fastest = min(step_time(b) for b in batch_sizes)
+    batch_size = max(b for b in batch_sizes if step_time(b) <= BATCH_TOLERANCE * fastest)
+    learner_threads = min(thread_candidates(), key=lambda threads: update_time[(batch_size, threads)])
+
+    # TMAX: throughput is flat in it, collection and learning both grow linearly.
+    # The longest that fits the budget, for the longest GAE horizon
+    tmax = TMAX
+    if args.hyperparams:
+        fits = [t for t in args.tmax if memory_estimate(state_size, num_agents, t, batch_size) <= budget]
+        if len(fits) == 0:
+            raise ValueError(f"no TMAX fits in {args.memory_gb} GB")
+        tmax = max(fits)
+    elif memory_estimate(state_size, num_agents, tmax, batch_size) > budget:
+        print(f"TMAX {tmax} of driver.py is over the {args.memory_gb} GB budget", file=sys.stderr)
+
+    # end to end: one rollout followed by EPOCHS passes over it
+    n_samples = tmax * num_agents
+    n_updates = EPOCHS * ((n_samples + batch_size - 1) // batch_size)
+    t_update = update_time[(batch_size, learner_threads)]
+
+    best = {
+        "interop_threads": args.interop,
+        "collector_threads": collector_threads,
+        "learner_threads": learner_threads,
+        "samples_per_sec": n_samples / (tmax * collect_step[collector_threads] + n_updates * t_update),
+        "updates_per_sec": 1 / t_update
+    }
+    if args.hyperparams:
+        best.update(batch_size=batch_size, tmax=tmax)
+
+    return best
+
+def worker_argv(args, interop):
+    argv = [sys.executable, os.path.abspath(__file__), "--worker", "--interop", str(interop),
+        "--memory_gb", str(args.memory_gb), "--agents", str(args.agents), "--step_latency", str(args.step_latency),
+        "--batch_sizes", *map(str, args.batch_sizes), "--tmax", *map(str, args.tmax)]
+    if args.fake:
+        argv.append("--fake")
+    if args.hyperparams:
+        argv.append("--hyperparams")
+    return argv
+
+def add_arguments(parser):
+    parser.add_argument("--fake", action="store_true", help="tune on the fake environment")
+    parser.add_argument("--agents", type=int, default=1, help="fake environment agents")
+    parser.add_argument("--step_latency", type=float, default=0., help="fake environment step latency, seconds")
+    parser.add_argument("--memory_gb", type=float, default=MEMORY_BUDGET_GB, help="memory budget for rollouts and minibatches")
+    parser.add_argument("--hyperparams", action="store_true",
+        help="also pick minibatch size and TMAX and write them to the profile: this changes the PPO update")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=BATCH_SIZES, help="minibatch sizes to try, with --hyperparams")
+    parser.add_argument("--tmax", type=int, nargs="+", default=TMAXS, help="rollout lengths to try, with --hyperparams")
+    parser.add_argument("--interop", type=int, nargs="+", default=None, help="inter-op thread counts to try")
+    parser.add_argument("-o", "--out", default=None, help="profile to write, defaults to one per host name")
+
+def parse_args(argv=None):
+    parser = ArgumentParser()
+    add_arguments(parser)
+    parser.add_argument("--worker", action="store_true", help=SUPPRESS)
+
+    return parser.parse_args(argv)
+
+def main(args):
+    best = None
+    for interop in args.interop or [t for t in thread_candidates() if t <= 4]:
+        print(f"Trying {interop} inter-op threads...")
+        out = subprocess.run(worker_argv(args, interop), stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        print(f"{interop} inter-op threads: {result}")
+
+        if best is None or result["samples_per_sec"] > best["samples_per_sec"]:
+            best = result
+
+    path = args.out or profile_path()
+    save_profile(best, path)
+    print(f"Saved profile to {path}: {best}")
+    return best
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.worker:
+        # single inter-op value: report the best configuration on stdout
+        args.interop = args.interop[0]
+        print(json.dumps(run_trials(args)))
+    else:
+        main(args)
@@ -0,0 +1,262 @@
+"""Benchmarks run through `ejik bench`
+
+Heavy dependencies are imported inside the benchmarks that need them
+"""
+
+import os
+import sys
+import time
+import subprocess
+import statistics
+
+PPO_DIR = os.path.split(os.path.abspath(__file__))[0]
+
+IMPORT_MODULES = ["ejik", "model", "eval"]
+IMPORT_TARGET = 2.0     # seconds allowed to cold-start an eval worker
+IMPORT_REPEATS = 5
+
+def time_import(module, repeats):
+    '''
+    Cold-start a fresh interpreter that imports module, repeats times
+
+    Returns:
+    list of wall clock times in seconds
+    '''
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", f"import {module}"], cwd=PPO_DIR, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+def bench_import(modules=None, repeats=None, target=None):
+    '''
+    Time cold imports of the given modules and compare the median against target
+
+    Returns:
+    True if all modules start under target
+    '''
+    modules = modules or IMPORT_MODULES
+    repeats = repeats or IMPORT_REPEATS
+    target = target or IMPORT_TARGET
+
+    ok = True
+    for module in modules:
+        times = time_import(module, repeats)
+        median = statistics.median(times)
+        passed = median <= target
+        ok = ok and passed
+
+        print(f"{module:>10}: median {median:.3f}s, min {min(times):.3f}s {'ok' if passed else f'over {target:.2f}s target'}")
+    return ok
+
+ROLLOUT_OBS_SIZE = [18, 84, 84]
+ROLLOUT_ACT_SIZE = 4
+ROLLOUT_AGENTS = 1
+ROLLOUT_STEPS = 200
+
+def count_allocations(fn):
+    '''
+    Number of tensor allocations made by fn(), as seen by the torch profiler
+    '''
+    from torch.profiler import profile, ProfilerActivity
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+
+    return sum(1 for e in prof.events() if e.name == "[memory]" and e.cpu_memory_usage > 0)
+
+def time_steps(fn, steps):
+    '''
+    Per-step wall clock times of fn() in milliseconds
+    '''
+    times = []
+    for _ in range(steps):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+def bench_rollout(obs_size=None, act_size=None, num_agents=None, steps=None):
+    '''
+    Per-step latency and allocation count of the rollout forward:
+    autograd forward + detach (the old create_trajectories path) vs. policy.rollout()
+    '''
+    import torch
+    from model import ActorCritic
+
+    obs_size = obs_size or ROLLOUT_OBS_SIZE
+    act_size = act_size or ROLLOUT_ACT_SIZE
+    num_agents = num_agents or ROLLOUT_AGENTS
+    steps = steps or ROLLOUT_STEPS
+
+    policy = ActorCritic(obs_size, act_size)
+    states = torch.rand(num_agents, *obs_size)
+
+    actions = torch.zeros(num_agents, act_size)
+    log_probs = torch.zeros(num_agents)
+    values = torch.zeros(num_agents)
+
+    def autograd_step():
+        return [v.detach() for v in policy(states)]
+
+    def rollout_step():
+        return policy.rollout(states, actions, log_probs, values)
+
+    print(f"obs {obs_size}, actions {act_size}, agents {num_agents}, {steps} steps")
+    for name, step in [("autograd", autograd_step), ("rollout", rollout_step)]:
+        # warm up
+        time_steps(step, 10)
+        times = time_steps(step, steps)
+        allocations = count_allocations(step)
+
+        print(f"{name:>10}: median {statistics.median(times):.3f} ms, min {min(times):.3f} ms, {allocations} allocations per step")
+
+PIPELINE_STEP_LATENCY = 0.005   # seconds per fake env step, each state stacks NUM_CONSEQ_FRAMES of them
+PIPELINE_TMAX = 64
+PIPELINE_FRAMES = 6
+
+def timed(collector, method, totals):
+    '''
+    Accumulate time spent in collector.method into totals[method]
+    '''
+    fn = getattr(collector, method)
+
+    def wrapper(*args):
+        start = time.perf_counter()
+        result = fn(*args)
+        totals[method] += time.perf_counter() - start
+        return result
+
+    setattr(collector, method, wrapper)
+
+def bench_pipeline(step_latency=None, num_agents=None, tmax=None):
+    '''
+    Serial vs. double-buffered collection over two fake environments with a given step latency.
+    Utilization is (inference time + env time) / wall time: at most 1 for serial, up to 2 when they overlap.
+    '''
+    from model import ActorCritic
+    from fake_env import FakeUnityEnvironment
+    from trajectories import TrajectoryCollector, PipelinedTrajectoryCollector, device
+
+    step_latency = PIPELINE_STEP_LATENCY if step_latency is None else step_latency
+    num_agents = num_agents or ROLLOUT_AGENTS
+    tmax = tmax or PIPELINE_TMAX
+
+    envs = [FakeUnityEnvironment(num_agents=num_agents, step_latency=step_latency) for _ in range(2)]
+    h, w, c = envs[0].obs_size
+    policy = ActorCritic([c * PIPELINE_FRAMES, h, w], envs[0].brains[envs[0].brain_names[0]].vector_action_space_size[0]).to(device)
+
+    print(f"{step_latency * 1000:.1f} ms per env step, {PIPELINE_FRAMES} frames per state, agents {num_agents}, tmax {tmax}")
+    for name in ["serial", "pipelined"]:
+        totals = {"act": 0., "observe": 0.}
+        collectors = [TrajectoryCollector(env, policy, num_agents, tmax=tmax, is_visual=True, visual_state_size=PIPELINE_FRAMES) for env in envs]
+        for collector in collectors:
+            timed(collector, "act", totals)
+            timed(collector, "observe", totals)
+
+        start = time.perf_counter()
+        if name == "serial":
+            for collector in collectors:
+                collector.create_trajectories()
+        else:
+            pipelined = PipelinedTrajectoryCollector(collectors)
+            pipelined.create_trajectories()
+            pipelined.close()
+        wall = time.perf_counter() - start
+
+        samples = 2 * tmax * num_agents
+        print(f"{name:>10}: {samples / wall:.1f} samples/sec, inference {totals['act']:.2f}s, env {totals['observe']:.2f}s, "
+            f"wall {wall:.2f}s, utilization {(totals['act'] + totals['observe']) / wall:.2f}")
+
+STREAM_TMAX = 64
+STREAM_CHUNK = 16
+STREAM_SEED = 0
+
+def seeded_collector(policy, num_agents, tmax, seed):
+    '''
+    Collector over a fresh fake environment, with environment and action sampling seeded:
+    every collector made with the same seed plays the same rollout
+    '''
+    import torch
+    from fake_env import FakeUnityEnvironment
+    from trajectories import TrajectoryCollector
+
+    env = FakeUnityEnvironment(num_agents=num_agents, seed=seed)
+    torch.manual_seed(seed)
+    return TrajectoryCollector(env, policy, num_agents, tmax=tmax, is_visual=True, visual_state_size=PIPELINE_FRAMES)
+
+def stream_through_spool(collector, chunk_size, spill_dir, max_chunks):
+    '''
+    Streamed rollout read back from a ChunkSpool, as driver.py trains on it
+
+    Returns:
+    list of the unnormalized chunks, the rollout concatenated from the spool
+    '''
+    import torch
+    from trajectories import ChunkSpool
+
+    spool = ChunkSpool(spill_dir, max_chunks=max_chunks)
+    raw = []
+    for chunk in collector.stream_trajectories(chunk_size, normalize=False):
+        raw.append(chunk)
+        spool.put(chunk)
+
+    chunks = list(spool)
+    spool.clear()
+    return raw, {k: torch.cat([c[k] for c in chunks], dim=0) for k in ["advantages", "returns"]}
+
+def check_stream(tmax=None, chunk_size=None, num_agents=None, seed=STREAM_SEED):
+    '''
+    Streamed rollouts against create_trajectories() on seeded fake environments:
+    - chunks of tmax steps, all spilled and read back through ChunkSpool, give the same advantages and returns
+    - each chunk of chunk_size steps has the GAE of the same steps of the full rollout,
+      bootstrapped from the value of the step after it (the full rollout's bootstrap for the last chunk)
+
+    Returns:
+    True if both match
+    '''
+    import tempfile
+    import torch
+    from model import ActorCritic
+    from fake_env import FakeUnityEnvironment
+    from trajectories import device
+
+    tmax = tmax or STREAM_TMAX
+    chunk_size = chunk_size or STREAM_CHUNK
+    num_agents = num_agents or ROLLOUT_AGENTS
+
+    env = FakeUnityEnvironment()
+    h, w, c = env.obs_size
+    policy = ActorCritic([c * PIPELINE_FRAMES, h, w], env.brains[env.brain_names[0]].vector_action_space_size[0]).to(device)
+
+    collector = seeded_collector(policy, num_agents, tmax, seed)
+    full = collector.create_trajectories()
+    last_values = policy.rollout_values(collector.last_states)
+
+    def close(name, a, b):
+        ok = torch.allclose(a, b, atol=1e-5)
+        print(f"{name:>30}: {'ok' if ok else f'max difference {(a - b).abs().max().item():.3g}'}")
+        return ok
+
+    ok = True
+    with tempfile.TemporaryDirectory() as spill_dir:
+        # one chunk, spilled to disk
+        _, streamed = stream_through_spool(seeded_collector(policy, num_agents, tmax, seed), tmax, spill_dir, 0)
+        for k in ["advantages", "returns"]:
+            ok = close(f"chunk {tmax} {k}", streamed[k], full[k]) and ok
+
+        # truncated GAE: each chunk against the matching steps of the full rollout
+        raw, _ = stream_through_spool(seeded_collector(policy, num_agents, tmax, seed), chunk_size, spill_dir, 1)
+
+    rewards, values, dones = [full[k].reshape(tmax, num_agents) for k in ["rewards", "values", "dones"]]
+    for i, chunk in enumerate(raw):
+        start = i * chunk_size
+        end = min(start + chunk_size, tmax)
+        bootstrap = values[end] if end < tmax else last_values
+
+        advantages, returns = collector.calc_returns(rewards[start : end], values[start : end], dones[start : end], bootstrap)
+        ok = close(f"chunk {chunk_size} steps {start}-{end} advantages", chunk["advantages"], advantages.reshape(-1)) and ok
+        ok = close(f"chunk {chunk_size} steps {start}-{end} returns", chunk["returns"], returns.reshape(-1)) and ok
+
+    return ok
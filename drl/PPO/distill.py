@@ -0,0 +1,220 @@
+import torch
+import numpy as np
+import copy
+import torch.nn as nn
+import torch.nn.functional as F
+from model import ActorCritic, ActorStudent, load_checkpoint, inference_mode
+
+from trajectories import TrajectoryCollector
+from argparse import ArgumentParser
+
+LR = 1e-03              # learning rate
+EPOCHS = 20             # passes over the distillation data
+BATCH_SIZE = 128        # minibatch size
+TMAX = 512              # rollout length when collecting states from the teacher
+NUM_SAMPLES = 8192      # states to collect from the teacher, about 1 GB at 18x84x84 uint8
+NUM_CONSEQ_FRAMES = 6   # number of consequtive frames that make up a state
+NUM_RUNS = 100          # episodes for reward parity
+LATENCY_BATCHES = [1, 64]
+LATENCY_STEPS = 100
+PIXEL_LEVELS = 255      # unity frames are 8-bit pixels scaled to [0, 1]: states are kept as uint8
+
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+def to_pixels(states):
+    return (states * PIXEL_LEVELS).round_().to(torch.uint8)
+
+def from_pixels(states):
+    '''
+    Float states back from to_pixels(). Datasets recorded as float pass through
+    '''
+    if states.dtype != torch.uint8:
+        return states
+    return states.float() / PIXEL_LEVELS
+
+def collect_states(trajectory_collector, num_samples):
+    '''
+    Roll out the teacher (the collector's policy) until num_samples states are seen
+
+    Returns:
+    (num_samples, C, H, W) uint8 tensor of states on CPU, see to_pixels()
+    '''
+    states = None
+    n = 0
+    while n < num_samples:
+        trajectories = trajectory_collector.create_trajectories()
+        batch = trajectories["states"][:num_samples - n]
+
+        if states is None:
+            states = torch.empty((num_samples, *batch.shape[1:]), dtype=torch.uint8)
+        states[n : n + batch.shape[0]] = to_pixels(batch).cpu()
+
+        n += batch.shape[0]
+        print(f"Collected {n} of {num_samples} states")
+
+    return states
+
+def distill(teacher, student, states, epochs=EPOCHS, batch_size=BATCH_SIZE, lr=LR):
+    '''
+    Train student to match the teacher's action means on states (kept on CPU, moved to device by the batch)
+
+    Returns:
+    mean loss of each epoch
+    '''
+    # sampling noise is not learned: serve with the teacher's
+    student.log_std.data.copy_(teacher.log_std.data)
+
+    optimizer = torch.optim.Adam(student.actor.parameters(), lr=lr)
+    n_samples = states.shape[0]
+    losses = []
+
+    for epoch in range(epochs):
+        idx = torch.randperm(n_samples)
+        epoch_loss = 0
+
+        for start in range(0, n_samples, batch_size):
+            batch = from_pixels(states[idx[start : start + batch_size]].to(device))
+
+            with torch.no_grad():
+                target = teacher.actor(batch)
+
+            loss = F.mse_loss(student.actor(batch), target)
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+            epoch_loss += loss.item() * batch.shape[0]
+
+        losses.append(epoch_loss / n_samples)
+        print(f"Epoch {epoch + 1} of {epochs}: loss {losses[-1]:.6f}")
+
+    return losses
+
+def count_params(module):
+    return sum(p.numel() for p in module.parameters())
+
+def count_flops(module, obs_size):
+    '''
+    Multiply-add FLOPs (2 per MAC) of the convolutions and linear layers in module for one observation
+    '''
+    flops = []
+
+    def conv_hook(layer, inputs, output):
+        k = layer.kernel_size[0] * layer.kernel_size[1] * layer.in_channels // layer.groups
+        flops.append(2 * k * output.numel())
+
+    def linear_hook(layer, inputs, output):
+        flops.append(2 * layer.in_features * output.numel())
+
+    hooks = []
+    for layer in module.modules():
+        if isinstance(layer, nn.Conv2d):
+            hooks.append(layer.register_forward_hook(conv_hook))
+        elif isinstance(layer, nn.Linear):
+            hooks.append(layer.register_forward_hook(linear_hook))
+
+    with torch.no_grad():
+        module(torch.zeros(1, *obs_size, device=next(module.parameters()).device))
+
+    for h in hooks:
+        h.remove()
+
+    return sum(flops)
+
+def cpu_latency(module, obs_size, batch_size, steps=LATENCY_STEPS):
+    '''
+    Median CPU forward latency in ms
+    '''
+    from bench import time_steps
+
+    module = copy.deepcopy(module).cpu()
+    x = torch.rand(batch_size, *obs_size)
+
+    with inference_mode():
+        time_steps(lambda: module(x), 10)
+        return float(np.median(time_steps(lambda: module(x), steps)))
+
+def report(teacher, student, obs_size, teacher_rewards=None, student_rewards=None):
+    '''
+    Compare the serving cost of the teacher actor and the student and, if given, their rewards
+    '''
+    rows = [
+        ("params", count_params(teacher.actor) + teacher.log_std.numel(), count_params(student)),
+        ("FLOPs", count_flops(teacher.actor, obs_size), count_flops(student.actor, obs_size)),
+    ]
+    for batch_size in LATENCY_BATCHES:
+        rows.append((f"CPU ms @ {batch_size}", cpu_latency(teacher.actor, obs_size, batch_size), cpu_latency(student.actor, obs_size, batch_size)))
+
+    print(f"{'':>14} {'teacher':>14} {'student':>14} {'ratio':>8}")
+    for name, t, s in rows:
+        print(f"{name:>14} {t:>14.6g} {s:>14.6g} {s / t:>8.3f}")
+
+    if teacher_rewards is not None and student_rewards is not None:
+        t, s = np.mean(teacher_rewards), np.mean(student_rewards)
+        print(f"{'reward':>14} {t:>14.3f} {s:>14.3f} {'delta':>8} {s - t:.3f}")
+
+def add_arguments(parser):
+    parser.add_argument("-m", "--model", required=True, help="teacher checkpoint")
+    parser.add_argument("-o", "--out", required=True, help="where to save the student")
+    parser.add_argument("--dataset", default=None, help="states recorded with --record, instead of collecting new ones")
+    parser.add_argument("--record", default=None, help="save collected states here")
+    parser.add_argument("--samples", type=int, default=NUM_SAMPLES, help="states to collect from the teacher")
+    parser.add_argument("--width", type=int, default=128, help="student hidden layer width")
+    parser.add_argument("--depth", type=int, default=1, help="student hidden layer count")
+    parser.add_argument("--depthwise", action="store_true", help="depthwise separable student convolutions")
+    parser.add_argument("--epochs", type=int, default=EPOCHS, help="distillation epochs")
+    parser.add_argument("-n", "--runs", type=int, default=NUM_RUNS, help="episodes to compare rewards, 0 to skip")
+
+def parse_args(argv=None):
+    parser = ArgumentParser()
+    add_arguments(parser)
+    return parser.parse_args(argv)
+
+def main(args):
+    from eval import open_env, play
+
+    # recorded states and no reward comparison need no unity environment
+    env = trajectory_collector = state_size = action_size = None
+    if args.dataset is None or args.runs > 0:
+        env, num_agents, action_size, state_size = open_env(train_mode=True)
+
+    teacher = ActorCritic.from_checkpoint(args.model, state_size, action_size, map_location=device).to(device)
+    state_size = teacher.state_dim
+    student = ActorStudent(state_size, teacher.action_dim, width=args.width, depth=args.depth, depthwise=args.depthwise).to(device)
+
+    if env is not None:
+        trajectory_collector = TrajectoryCollector(env, teacher, num_agents, tmax=TMAX, is_visual=True, visual_state_size=NUM_CONSEQ_FRAMES)
+
+    if args.dataset is not None:
+        states = load_checkpoint(args.dataset)["states"]
+    else:
+        states = collect_states(trajectory_collector, args.samples)
+        if args.record is not None:
+            torch.save({"states": states}, args.record)
+
+    distill(teacher, student, states, epochs=args.epochs)
+    student.save(args.out)
+    print(f"Saved student to {args.out}")
+
+    teacher_rewards = student_rewards = None
+    if args.runs > 0:
+        trajectory_collector.is_training = False
+        trajectory_collector.reset()
+
+        rewards = []
+        for policy in [teacher, student]:
+            policy.eval()
+            with torch.no_grad():
+                total_rewards, _ = play(trajectory_collector, lambda state: policy(state)[0].cpu().numpy(), args.runs)
+            rewards.append(total_rewards)
+
+        teacher_rewards, student_rewards = rewards
+
+    report(teacher, student, state_size, teacher_rewards, student_rewards)
+
+    if env is not None:
+        env.close()
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -9,8 +9,10 @@ from mlagents.envs import UnityEnvironment
 from agent import PPOAgent
 import tensorboardX
 from utils import RewardTracker, TBMeanTracker
-from trajectories import TrajectoryCollector
+from trajectories import TrajectoryCollector, PipelinedTrajectoryCollector, ChunkSpool
+from autotune import load_profile, profile_path
 import torch.optim.lr_scheduler as lr_scheduler
+from argparse import ArgumentParser
 
 
 LR = 5e-04              # learing rate
@@ -31,16 +33,59 @@ SAVE_EVERY = 1000
 debug = False
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-if __name__ == "__main__":
-
-    root_path = os.path.split(os.path.split(__file__)[0])[0]
-    if root_path == '':
-        root_path = os.path.abspath("..")
+def add_arguments(parser):
+    '''
+    Training options, shared with 'ejik train'. Destinations are main()'s keyword arguments
+    '''
+    parser.add_argument("-e", "--env", dest="env_path", default=None, help="path to the unity environment")
+    parser.add_argument("-c", "--ckpt_dir", dest="ckpt_path", default=None, help="where to save checkpoints")
+    parser.add_argument("--debug", action="store_true", help="connect to the unity editor")
+    parser.add_argument("--pipeline", action="store_true", help="overlap inference with env steps over two environments")
+    parser.add_argument("--chunk", dest="chunk_size", type=int, default=None, help="stream rollouts in chunks of this many steps")
+    parser.add_argument("--max_chunks", type=int, default=1, help="streamed chunks kept in memory, the rest spill to disk")
+    parser.add_argument("-p", "--profile", dest="profile_file", default=None,
+        help="throughput profile, defaults to the one autotune wrote for this host")
+
+def parse_args(argv=None):
+    parser = ArgumentParser()
+    add_arguments(parser)
+    return parser.parse_args(argv)
+
+def main(env_path=None, ckpt_path=None, debug=debug, profile_file=None, pipeline=False, chunk_size=None, max_chunks=1):
+
+    # check the options before any unity process starts
+    if pipeline and chunk_size is not None:
+        raise ValueError("streamed rollouts are not supported with the pipelined collector")
+    if pipeline and debug:
+        raise ValueError("the unity editor runs a single environment, the pipelined collector needs a build")
+    if chunk_size is not None and chunk_size <= 0:
+        raise ValueError(f"chunk size must be positive, got {chunk_size}")
+    if max_chunks < 0:
+        raise ValueError(f"max chunks must not be negative, got {max_chunks}")
+
+    # machine-specific throughput settings written by autotune.py
+    profile_file = profile_file or profile_path()
+    profile = load_profile(profile_file)
+    if len(profile) > 0:
+        print(f"Loaded throughput profile {profile_file}")
+        if "interop_threads" in profile:
+            torch.set_num_interop_threads(profile["interop_threads"])
+
+    batch_size = profile.get("batch_size", BATCH_SIZE)
+    tmax = profile.get("tmax", TMAX)
+    if "batch_size" in profile or "tmax" in profile:
+        print(f"Profile sets minibatch size {batch_size} and TMAX {tmax} (defaults {BATCH_SIZE} and {TMAX})")
+    collector_threads = profile.get("collector_threads", torch.get_num_threads())
+    learner_threads = profile.get("learner_threads", torch.get_num_threads())
+
+    root_path = os.path.split(os.path.split(os.path.abspath(__file__))[0])[0]
 
     # where the environment file is located
-    env_path = os.path.join(root_path, "../env/ejik")
+    if env_path is None:
+        env_path = os.path.join(root_path, "../env/ejik")
     # where to save the model
-    ckpt_path = os.path.join(root_path, "saved_model")
+    if ckpt_path is None:
+        ckpt_path = os.path.join(root_path, "saved_model")
 
     if not os.path.exists(ckpt_path):
         os.makedirs(ckpt_path)
@@ -49,109 +94,148 @@ if __name__ == "__main__":
         env = UnityEnvironment(file_name=None)
     else:
         env = UnityEnvironment(file_name=env_path)
-        
-    brain_name = env.brain_names[0]
-    brain = env.brains[brain_name]
 
-    env_info = env.reset(train_mode=True)[brain_name]
+    envs = [env]
+    trajectory_collector = spool = None
+    try:
+        brain_name = env.brain_names[0]
+        brain = env.brains[brain_name]
 
-    num_agents = len(env_info.agents)
-    print('Number of agents:', num_agents)
+        env_info = env.reset(train_mode=True)[brain_name]
 
-    # size of each action
-    action_size = brain.vector_action_space_size[0]
-    print('Size of each action:', action_size)
+        num_agents = len(env_info.agents)
+        print('Number of agents:', num_agents)
 
-    # examine the state space 
-    states = env_info.visual_observations
-    state_size = list(states[0][0].transpose(2, 0, 1).shape)
-    state_size[0] *= NUM_CONSEQ_FRAMES
-    
-    # torch.manual_seed(SEED)
-    # np.random.seed(SEED)
+        # size of each action
+        action_size = brain.vector_action_space_size[0]
+        print('Size of each action:', action_size)
 
-    # create policy to be trained & optimizer
-    policy = ActorCritic(state_size, action_size).to(device)
-
-    writer = tensorboardX.SummaryWriter(comment=f"-ejik")
+        # examine the state space 
+        states = env_info.visual_observations
+        state_size = list(states[0][0].transpose(2, 0, 1).shape)
+        state_size[0] *= NUM_CONSEQ_FRAMES
     
-    trajectory_collector = TrajectoryCollector(env, policy, num_agents, tmax=TMAX, gamma=GAMMA, gae_lambda=GAE_LAMBDA, debug=debug, is_visual=True, visual_state_size=NUM_CONSEQ_FRAMES)
+        # torch.manual_seed(SEED)
+        # np.random.seed(SEED)
 
-    tb_tracker = TBMeanTracker(writer, EPOCHS)
+        # create policy to be trained & optimizer
+        policy = ActorCritic(state_size, action_size, verbose=True).to(device)
 
-    agent = PPOAgent(policy, tb_tracker, LR, EPSILON, BETA)
+        writer = tensorboardX.SummaryWriter(comment=f"-ejik")
     
-    #scheduler = lr_scheduler.LambdaLR(agent.optimizer, lambda ep: 0.1 if ep == STEP_DECAY else 1)
-    scheduler = lr_scheduler.StepLR(agent.optimizer, step_size=STEP_DECAY, gamma=GAMMA)
-    n_episodes = 0
-    max_score = - np.Inf
+        trajectory_collector = TrajectoryCollector(env, policy, num_agents, tmax=tmax, gamma=GAMMA, gae_lambda=GAE_LAMBDA, debug=debug, is_visual=True, visual_state_size=NUM_CONSEQ_FRAMES)
 
-    traj_attributes = ["states", "actions", "log_probs", "advantages", "returns"]
-    solved = False
-    start = None
-    step = 0
+        # second environment: its steps overlap with inference for the first one
+        if pipeline:
+            env_b = UnityEnvironment(file_name=env_path, worker_id=1)
+            envs.append(env_b)
+            trajectory_collector = PipelinedTrajectoryCollector([
+                trajectory_collector,
+                TrajectoryCollector(env_b, policy, num_agents, tmax=tmax, gamma=GAMMA, gae_lambda=GAE_LAMBDA, debug=debug, is_visual=True, visual_state_size=NUM_CONSEQ_FRAMES)
+            ])
 
-    with RewardTracker(writer, mean_window=AVG_WIN, print_every=AVG_WIN // 2) as reward_tracker:
-        d = datetime.datetime.today()
+        # streamed rollouts: chunks beyond max_chunks wait on disk for the learner
+        spool = None
+        if chunk_size is not None:
+            spool = ChunkSpool(os.path.join(ckpt_path, "spool"), max_chunks=max_chunks)
 
-        print(f"Started training run: at {d.strftime('%d-%m-%Y %H:%M:%S')}")
+        tb_tracker = TBMeanTracker(writer, EPOCHS)
 
-        while True:
-            
-            trajectories = trajectory_collector.create_trajectories()
-            
-            n_samples = trajectories['actions'].shape[0]
-            n_batches = int((n_samples + BATCH_SIZE - 1) / BATCH_SIZE)
+        agent = PPOAgent(policy, tb_tracker, LR, EPSILON, BETA)
+    
+        #scheduler = lr_scheduler.LambdaLR(agent.optimizer, lambda ep: 0.1 if ep == STEP_DECAY else 1)
+        scheduler = lr_scheduler.StepLR(agent.optimizer, step_size=STEP_DECAY, gamma=GAMMA)
+        n_episodes = 0
+        max_score = - np.Inf
 
-            # idx = np.arange(n_samples)
-            # np.random.shuffle(idx)
-            # for k, v in trajectories.items():
-            #    trajectories[k] = v[idx]
+        traj_attributes = ["states", "actions", "log_probs", "advantages", "returns"]
+        solved = False
+        start = None
+        step = 0
 
-            # first see our rewards and then train
-            rewards = trajectory_collector.scores_by_episode[n_episodes : ]
+        with RewardTracker(writer, mean_window=AVG_WIN, print_every=AVG_WIN // 2) as reward_tracker:
+            d = datetime.datetime.today()
 
-            # record the number of "dones" per trajectory
-            writer.add_scalar("episodes_per_trajectory", len(rewards), step)
-            step += 1
+            print(f"Started training run: at {d.strftime('%d-%m-%Y %H:%M:%S')}")
 
-            end_time = time.time()
-            for idx_r, reward in enumerate(rewards):
-                mean_reward = reward_tracker.reward(reward, n_episodes + idx_r, end_time - start if start is not None else 0)
+            while True:
+            
+                torch.set_num_threads(collector_threads)
+                if spool is None:
+                    chunks = [trajectory_collector.create_trajectories()]
+                else:
+                    spool.clear()
+                    for chunk in trajectory_collector.stream_trajectories(chunk_size, normalize=False):
+                        # the learner needs only these: next states alone would double what spills
+                        spool.put({k: chunk[k] for k in traj_attributes})
+                    chunks = spool
+
+                # idx = np.arange(n_samples)
+                # np.random.shuffle(idx)
+                # for k, v in trajectories.items():
+                #    trajectories[k] = v[idx]
+
+                # first see our rewards and then train
+                rewards = trajectory_collector.scores_by_episode[n_episodes : ]
+
+                # record the number of "dones" per trajectory
+                writer.add_scalar("episodes_per_trajectory", len(rewards), step)
+                step += 1
+
+                end_time = time.time()
+                for idx_r, reward in enumerate(rewards):
+                    mean_reward = reward_tracker.reward(reward, n_episodes + idx_r, end_time - start if start is not None else 0)
                 
-                # we switch LR to 1e-4 in the middle
-                scheduler.step()
-
-                # keep current spectacular scores
-                if n_episodes > 0 and (reward > max_score or (n_episodes + idx_r) % SAVE_EVERY == 0):
-                    torch.save(policy.state_dict(), os.path.join(ckpt_path, f'checkpoint_actor_{reward:.03f}.pth'))
-                    max_score = reward
-
-                if mean_reward is not None and mean_reward >= SOLVED_SCORE:
-                    torch.save(policy.state_dict(), os.path.join(ckpt_path, f'checkpoint_actor_{mean_reward:.03f}.pth'))
-                    solved_episode = n_episodes + idx_r - AVG_WIN - 1
-                    print(f"Solved in {solved_episode if solved_episode > 0 else n_episodes + idx_r} episodes")
-                    solved = True
+                    # we switch LR to 1e-4 in the middle
+                    scheduler.step()
+
+                    # keep current spectacular scores
+                    if n_episodes > 0 and (reward > max_score or (n_episodes + idx_r) % SAVE_EVERY == 0):
+                        policy.save(os.path.join(ckpt_path, f'checkpoint_actor_{reward:.03f}.pth'))
+                        max_score = reward
+
+                    if mean_reward is not None and mean_reward >= SOLVED_SCORE:
+                        policy.save(os.path.join(ckpt_path, f'checkpoint_actor_{mean_reward:.03f}.pth'))
+                        solved_episode = n_episodes + idx_r - AVG_WIN - 1
+                        print(f"Solved in {solved_episode if solved_episode > 0 else n_episodes + idx_r} episodes")
+                        solved = True
+                        break
+
+                if solved:
                     break
 
-            if solved:
-                break
+                start = time.time()
+                # train agents in a round-robin for the number of epochs,
+                # all of them on one chunk before the next is loaded: a spilled chunk is read once per rollout
+                torch.set_num_threads(learner_threads)
+                for trajectories in chunks:
+                    n_samples = trajectories['actions'].shape[0]
+                    n_batches = int((n_samples + batch_size - 1) / batch_size)
 
-            start = time.time()
-            # train agents in a round-robin for the number of epochs
-            for epoch in range(EPOCHS):
-                for batch in range(n_batches):    
+                    for epoch in range(EPOCHS):
+                        for batch in range(n_batches):    
 
-                    idx_start = BATCH_SIZE * batch
-                    idx_end = idx_start + BATCH_SIZE
+                            idx_start = batch_size * batch
+                            idx_end = idx_start + batch_size
 
-                    # select the batch of trajectory entries
-                    params = [trajectories[k][idx_start : idx_end] for k in traj_attributes]
+                            # select the batch of trajectory entries
+                            params = [trajectories[k][idx_start : idx_end] for k in traj_attributes]
 
-                    (states, actions, log_probs, advantages, returns) = params
+                            (states, actions, log_probs, advantages, returns) = params
 
-                    agent.learn(log_probs, states, actions, advantages, returns)
+                            agent.learn(log_probs, states, actions, advantages, returns)
 
-            end_time = time.time()
+                end_time = time.time()
 
-            n_episodes += len(rewards)
\ No newline at end of file
+                n_episodes += len(rewards)
+    finally:
+        # the last rollout's spilled chunks can take gigabytes
+        if spool is not None:
+            spool.clear()
+        if isinstance(trajectory_collector, PipelinedTrajectoryCollector):
+            trajectory_collector.close()
+        for e in envs:
+            e.close()
+
+if __name__ == "__main__":
+    main(**vars(parse_args()))
@@ -0,0 +1,122 @@
+"""Ejik command line
+
+    python ejik.py {train,eval,tournament,distill,autotune,export,bench} ...
+
+Subcommands import what they need when they run,
+so short-lived eval workers do not pay for the whole stack on start up
+"""
+
+import sys
+import importlib
+from argparse import ArgumentParser
+
+def do_train(args):
+    from driver import main
+    main(env_path=args.env_path, ckpt_path=args.ckpt_path, debug=args.debug, profile_file=args.profile_file,
+        pipeline=args.pipeline, chunk_size=args.chunk_size, max_chunks=args.max_chunks)
+
+def do_eval(args):
+    from eval import main
+    main(args)
+
+def do_tournament(args):
+    from tournament import main
+    main(args)
+
+def do_distill(args):
+    from distill import main
+    main(args)
+
+def do_autotune(args):
+    from autotune import main
+    main(args)
+
+def do_export(args):
+    '''
+    Re-save a checkpoint with shape metadata, mapped to CPU
+    '''
+    from model import load_policy
+
+    try:
+        policy = load_policy(args.model, obs_size=args.obs_size)
+    except ValueError as e:
+        print(f"{args.model}: {e}", file=sys.stderr)
+        return 1
+
+    policy.save(args.out)
+    print(f"Exported {args.model} -> {args.out}: obs {policy.state_dim}, actions {policy.action_dim}, conv {policy.conv_size}")
+
+def do_bench(args):
+    import bench
+
+    if args.benchmark == "import":
+        return 0 if bench.bench_import(args.modules, args.repeats, args.target) else 1
+    if args.benchmark == "rollout":
+        bench.bench_rollout(args.obs_size, args.act_size, args.agents, args.steps)
+    if args.benchmark == "pipeline":
+        bench.bench_pipeline(args.step_latency, args.agents, args.tmax)
+    if args.benchmark == "stream":
+        return 0 if bench.check_stream(args.tmax, args.chunk, args.agents) else 1
+
+MODULE_COMMANDS = {
+    "train": ("driver", do_train, "train PPO agent"),
+    "eval": ("eval", do_eval, "evaluate a checkpoint"),
+    "tournament": ("tournament", do_tournament, "rank many checkpoints in one batched evaluation"),
+    "distill": ("distill", do_distill, "distill a checkpoint into a compact actor-only student"),
+    "autotune": ("autotune", do_autotune, "tune minibatch size, TMAX and thread counts for this machine"),
+}
+
+def parse_args(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    chosen = argv[0] if len(argv) > 0 else None
+
+    parser = ArgumentParser(prog="ejik")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    # these subcommands declare their options in their own module:
+    # only the chosen one is imported
+    for name, (module, handler, help) in MODULE_COMMANDS.items():
+        command = commands.add_parser(name, help=help)
+        if name == chosen:
+            importlib.import_module(module).add_arguments(command)
+        command.set_defaults(func=handler)
+
+    export = commands.add_parser("export", help="re-save a checkpoint with shape metadata")
+    export.add_argument("-m", "--model", required=True, help="checkpoint to export")
+    export.add_argument("-o", "--out", required=True, help="exported checkpoint")
+    export.add_argument("--obs_size", type=int, nargs=3, default=None, metavar=("C", "H", "W"),
+        help="stacked observation size, needed for plain state dicts")
+    export.set_defaults(func=do_export)
+
+    bench = commands.add_parser("bench", help="run benchmarks")
+    benchmarks = bench.add_subparsers(dest="benchmark")
+    benchmarks.required = True
+
+    bench_import = benchmarks.add_parser("import", help="cold start time of python modules")
+    bench_import.add_argument("-m", "--modules", nargs="+", default=None, help="modules to import")
+    bench_import.add_argument("-n", "--repeats", type=int, default=None, help="cold starts per module")
+    bench_import.add_argument("-t", "--target", type=float, default=None, help="maximum median start up time, seconds")
+
+    bench_rollout = benchmarks.add_parser("rollout", help="per-step latency and allocations of rollout inference")
+    bench_rollout.add_argument("--obs_size", type=int, nargs=3, default=None, metavar=("C", "H", "W"), help="stacked observation size")
+    bench_rollout.add_argument("--act_size", type=int, default=None, help="action space size")
+    bench_rollout.add_argument("-a", "--agents", type=int, default=None, help="number of agents")
+    bench_rollout.add_argument("-s", "--steps", type=int, default=None, help="timed steps")
+
+    bench_pipeline = benchmarks.add_parser("pipeline", help="serial vs. double-buffered collection on fake environments")
+    bench_pipeline.add_argument("-l", "--step_latency", type=float, default=None, help="fake env step latency, seconds")
+    bench_pipeline.add_argument("-a", "--agents", type=int, default=None, help="agents per environment")
+    bench_pipeline.add_argument("--tmax", type=int, default=None, help="rollout length")
+
+    bench_stream = benchmarks.add_parser("stream", help="check streamed rollouts against whole ones on seeded fake environments")
+    bench_stream.add_argument("--tmax", type=int, default=None, help="rollout length")
+    bench_stream.add_argument("--chunk", type=int, default=None, help="chunk length for the truncated GAE check")
+    bench_stream.add_argument("-a", "--agents", type=int, default=None, help="agents per environment")
+    bench.set_defaults(func=do_bench)
+
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(args.func(args))
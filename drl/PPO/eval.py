@@ -3,14 +3,12 @@ import numpy as np
 import time, datetime
 import os
 import sys
-from model import ActorCritic
+from model import load_policy
 
 from mlagents.envs import UnityEnvironment
 from agent import PPOAgent
 from trajectories import TrajectoryCollector
 from argparse import ArgumentParser
-import matplotlib.pyplot as plt
-import pandas as pd
 
 NUM_CONSEQ_FRAMES = 6
 NUM_RUNS = 1000
@@ -18,13 +16,14 @@ NUM_RUNS = 1000
 debug = False
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 ax2 = ax1 = None
-plt.figure(figsize=(20, 10))
 
 def plot(rewards, episode_lengths, is_random):
+    import matplotlib.pyplot as plt
 
     global ax1, ax2
 
     if ax1 is None:
+        plt.figure(figsize=(20, 10))
         ax1 = plt.subplot(121)
         ax1.set_title(f'Average reward')
     ax1.plot(rewards, label= "random" if is_random else "brain")
@@ -35,28 +34,14 @@ def plot(rewards, episode_lengths, is_random):
     ax2.plot(episode_lengths, label= "random" if is_random else "brain")
     ax2.legend()
 
-def parse_args():
-    parser = ArgumentParser()
-    parser.add_argument("-m", "--model", default=None, help="full path to the model")
-    parser.add_argument("-o", "--out_dir", default=None, help="output directory")
+def open_env(train_mode=False, worker_id=0, debug=debug):
+    '''
+    Start the unity environment, worker_id tells apart environments running side by side
 
-    args = parser.parse_args()
-    return args
-
-if __name__ == "__main__":
-
-    debug = False
-    
-    args = parse_args()
-    ckpt_path = args.model
-    out_dir = args.out_dir
-    
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
-    
-    root_path = os.path.split(os.path.split(__file__)[0])[0]
-    if root_path == '':
-        root_path = os.path.abspath("..")
+    Returns:
+    env, number of agents, action size, stacked visual observation size (C, H, W)
+    '''
+    root_path = os.path.split(os.path.split(os.path.abspath(__file__))[0])[0]
 
     # where the environment file is located
     env_path = os.path.join(root_path, "../env/ejik")
@@ -64,12 +49,12 @@ if __name__ == "__main__":
     if debug:
         env = UnityEnvironment(file_name=None)
     else:
-        env = UnityEnvironment(file_name=env_path)
+        env = UnityEnvironment(file_name=env_path, worker_id=worker_id)
         
     brain_name = env.brain_names[0]
     brain = env.brains[brain_name]
 
-    env_info = env.reset(train_mode=False)[brain_name]
+    env_info = env.reset(train_mode=train_mode)[brain_name]
 
     num_agents = len(env_info.agents)
     print('Number of agents:', num_agents)
@@ -82,47 +67,84 @@ if __name__ == "__main__":
     states = env_info.visual_observations
     state_size = list(states[0][0].transpose(2, 0, 1).shape)
     state_size[0] *= NUM_CONSEQ_FRAMES
+
+    return env, num_agents, action_size, state_size
+
+def play(trajectory_collector, act, num_runs):
+    '''
+    Play num_runs episodes, act(state) returns numpy actions
+
+    Returns:
+    total reward and length of each episode
+    '''
+    state = trajectory_collector.last_states
+    total_rewards = []
+    episode_lengths = []
+    for i_run in range(num_runs):
+        sum_reward = 0
+        ep = 0
+        while True:
+            ep += 1
+            actions = act(state)
+
+            next_states, rewards, dones = trajectory_collector.next_observation(actions)
+
+            sum_reward += rewards.cpu().numpy().sum()
+
+            state = next_states
+            if np.any(dones.cpu().numpy()):
+                trajectory_collector.reset()
+                state = trajectory_collector.last_states
+                total_rewards.append(sum_reward)
+                episode_lengths.append(ep)
+                print(f"{i_run + 1} of {num_runs}: total time: {ep}: total reward: {sum_reward:.3f}")
+                break
+
+    return total_rewards, episode_lengths
+
+def add_arguments(parser):
+    parser.add_argument("-m", "--model", default=None, help="full path to the model")
+    parser.add_argument("-o", "--out_dir", default=None, help="output directory")
+
+def parse_args(argv=None):
+    parser = ArgumentParser()
+    add_arguments(parser)
+    return parser.parse_args(argv)
+
+def main(args):
+    # plotting libraries are slow to import: keep them out of module import
+    import matplotlib.pyplot as plt
+    import pandas as pd
+
+    ckpt_path = args.model
+    out_dir = args.out_dir
     
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    
+    env, num_agents, action_size, state_size = open_env(train_mode=False)
+
     # create policy
-    policy = ActorCritic(state_size, action_size, model_path=ckpt_path).to(device)
+    policy = load_policy(ckpt_path, state_size, action_size, map_location=device).to(device)
 
     trajectory_collector = TrajectoryCollector(env, policy, num_agents, is_visual=True, visual_state_size=NUM_CONSEQ_FRAMES, is_training=False)
 
     agent = PPOAgent(policy)
     
-    state = trajectory_collector.last_states
     is_random_run = [1, 0, 2]
 
     for is_random in is_random_run:
         print(f"Staring {'' if is_random else 'non' } random run...")
-        total_rewards = []
-        avg_episode_length = 0
-        episode_lengths = []
-        for i_run in range(NUM_RUNS):
-            sum_reward = 0
-            ep = 0
-            while True:
-                ep += 1
-                if is_random == 1: 
-                    actions = agent.act(state).cpu().numpy()
-                elif is_random == 2:
-                    actions = np.r_[np.random.randn(3), [0.5]]
-                else:
-                    actions = np.random.randn(4)
-
-                next_states, rewards, dones = trajectory_collector.next_observation(actions)
-
-                sum_reward += rewards.cpu().numpy().sum()
-
-                state = next_states
-                if np.any(dones.cpu().numpy()):
-                    trajectory_collector.reset()
-                    state = trajectory_collector.last_states
-                    total_rewards.append(sum_reward)
-                    episode_lengths.append(ep)
-                    print(f"{i_run + 1} of {NUM_RUNS}: total time: {ep}: total reward: {sum_reward:.3f}")
-                    break
-        
+
+        if is_random == 1:
+            act = lambda state: agent.act(state).cpu().numpy()
+        elif is_random == 2:
+            act = lambda state: np.r_[np.random.randn(3), [0.5]]
+        else:
+            act = lambda state: np.random.randn(4)
+
+        total_rewards, episode_lengths = play(trajectory_collector, act, NUM_RUNS)
+
         df = pd.DataFrame(data = {"length": episode_lengths, "reward": total_rewards})
         file_path = r'random.csv'
 
@@ -140,4 +162,7 @@ if __name__ == "__main__":
         plot(total_rewards, episode_lengths, is_random)
 
     plt.savefig(os.path.join(out_dir, r'comparison.png'))
-    #plt.show()
\ No newline at end of file
+    #plt.show()
+
+if __name__ == "__main__":
+    main(parse_args())
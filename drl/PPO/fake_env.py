@@ -0,0 +1,62 @@
+"""Stand-in for mlagents UnityEnvironment for benchmarks and tuning without a Unity build
+
+Implements the part of the API TrajectoryCollector uses
+"""
+
+import time
+import numpy as np
+
+class BrainParameters:
+
+    def __init__(self, action_size):
+        self.vector_action_space_size = [action_size]
+
+class BrainInfo:
+
+    def __init__(self, visual_observations, rewards, local_done, agents):
+        self.visual_observations = visual_observations
+        self.vector_observations = np.zeros((len(agents), 1), dtype=np.float32)
+        self.rewards = rewards
+        self.local_done = local_done
+        self.agents = agents
+
+class FakeUnityEnvironment:
+
+    def __init__(self, num_agents=1, obs_size=(84, 84, 3), action_size=4, step_latency=0.0, episode_length=200, seed=None):
+        '''
+        num_agents - number of agents
+        obs_size - (H, W, C) of a visual observation, as unity returns it
+        action_size - action space size
+        step_latency - seconds each step() blocks for, as if waiting on unity
+        episode_length - steps before agents are done
+        '''
+        self.num_agents = num_agents
+        self.obs_size = tuple(obs_size)
+        self.step_latency = step_latency
+        self.episode_length = episode_length
+        self.rng = np.random.RandomState(seed)
+
+        self.brain_names = ["FakeBrain"]
+        self.brains = {"FakeBrain": BrainParameters(action_size)}
+        self.n_steps = 0
+
+    def brain_info(self, rewards, local_done):
+        obs = self.rng.rand(self.num_agents, *self.obs_size).astype(np.float32)
+        return {self.brain_names[0]: BrainInfo([obs], rewards, local_done, list(range(self.num_agents)))}
+
+    def reset(self, train_mode=True):
+        self.n_steps = 0
+        return self.brain_info([0.] * self.num_agents, [False] * self.num_agents)
+
+    def step(self, vector_action=None, text_action=None):
+        if self.step_latency > 0:
+            time.sleep(self.step_latency)
+
+        self.n_steps += 1
+        done = self.n_steps >= self.episode_length
+        rewards = list(self.rng.randn(self.num_agents) * 0.01)
+
+        return self.brain_info(rewards, [done] * self.num_agents)
+
+    def close(self):
+        pass
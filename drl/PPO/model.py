@@ -2,29 +2,78 @@ import torch
 import torch.nn as nn
 import numpy as np
 
+# torch.inference_mode appeared in torch 1.9, older versions get the no_grad equivalent
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+def load_checkpoint(model_path, map_location="cpu"):
+    '''
+    Load a checkpoint memory-mapped onto map_location, so GPU-saved weights open on CPU-only hosts.
+    Falls back to a regular load for legacy (non-zip) files and torch versions without mmap
+    '''
+    try:
+        return torch.load(model_path, map_location=map_location, mmap=True)
+    except (TypeError, RuntimeError):
+        return torch.load(model_path, map_location=map_location)
+
 def xavier(layer):
     if isinstance(layer, nn.Conv2d) or isinstance(layer, nn.Linear):
         nn.init.xavier_uniform_(layer.weight)
 
+def conv_layers(in_channels):
+    '''
+    Convolutional trunk shared by ActorCritic and ActorStudent
+    '''
+    return [
+        nn.Conv2d(in_channels, 16, 4, stride=4),
+        nn.LeakyReLU(),
+        nn.Conv2d(16, 32, 3, stride=2),
+        nn.LeakyReLU(),
+        nn.Conv2d(32, 64, 3, stride=2),
+    ]
+
+def conv_out_size(layers, obs_size):
+    '''
+    Flattened output size of layers for one observation, via a dummy forward
+    '''
+    with torch.no_grad():
+        o = nn.Sequential(*layers)(torch.zeros(1, *obs_size))
+    return int(np.prod(o.size()))
+
 class Flatten(nn.Module):
 
     def forward(self, x):
         return x.view(x.size()[0], -1)
 
 class ActorCritic(nn.Module):
-    def __init__(self, obs_size, act_size, model_path=None):
+    def __init__(self, obs_size, act_size, model_path=None, map_location="cpu", verbose=False):
         '''
         obs_size - (C, H, W) tuple of a visual observation
         act_size - action space size
+        model_path - checkpoint to load: either a plain state dict or the output of save().
+            May also be a checkpoint already returned by load_checkpoint()
+        map_location - device the checkpoint tensors are loaded onto
+        verbose - print the network
         '''
         super().__init__()
 
         self.action_dim = act_size
-        self.state_dim = obs_size
-        
-        conv_size = self.get_conv_out()
+        self.state_dim = list(obs_size)
+
+        checkpoint = model_path
+        if isinstance(model_path, str):
+            checkpoint = load_checkpoint(model_path, map_location)
+        state_dict = checkpoint
+
         self.fc_hidden = self.hidden_layers()
 
+        # checkpoints written by save() carry the conv output size, no need for a dummy forward
+        if isinstance(checkpoint, dict) and "state_dict" in checkpoint:
+            state_dict = checkpoint["state_dict"]
+            conv_size = checkpoint["conv_size"]
+        else:
+            conv_size = self.get_conv_out()
+        self.conv_size = conv_size
+
         fc_critic = self.fc_hidden \
             + [Flatten(), 
                 nn.Linear(conv_size, conv_size // 2),
@@ -42,31 +91,54 @@ class ActorCritic(nn.Module):
         self.critic = nn.Sequential(*fc_critic)
         self.log_std = nn.Parameter(torch.zeros(1, act_size))
 
-        print(f"Actor: {self.actor}")
-        print(f"Critic: {self.critic}")
-        
-        if model_path is None:
+        if verbose:
+            print(f"Actor: {self.actor}")
+            print(f"Critic: {self.critic}")
+
+        if state_dict is None:
             self.init_weights()
         else:
-            self.load_state_dict(torch.load(model_path))
+            self.load_state_dict(state_dict)
+
+    def save(self, path):
+        '''
+        Save weights together with the shape metadata needed to rebuild the network
+        '''
+        torch.save({
+            "state_dict": self.state_dict(),
+            "obs_size": self.state_dim,
+            "act_size": self.action_dim,
+            "conv_size": self.conv_size
+        }, path)
+
+    @classmethod
+    def from_checkpoint(cls, model_path, obs_size=None, act_size=None, map_location="cpu", **kwargs):
+        '''
+        Rebuild the network from a checkpoint path or one returned by load_checkpoint().
+        Shapes come from the metadata written by save(), plain state dicts need obs_size
+        '''
+        checkpoint = model_path
+        if isinstance(model_path, str):
+            checkpoint = load_checkpoint(model_path, map_location)
+
+        if "state_dict" in checkpoint:
+            obs_size, act_size = checkpoint["obs_size"], checkpoint["act_size"]
+        elif obs_size is None:
+            raise ValueError("plain state dict without shape metadata: the observation size is needed, or re-save it with 'ejik export'")
+        elif act_size is None:
+            act_size = checkpoint["log_std"].shape[-1]
 
+        return cls(obs_size, act_size, model_path=checkpoint, **kwargs)
 
     def init_weights(self):
         self.actor.apply(xavier)
         self.critic.apply(xavier)
 
     def hidden_layers(self):
-        return [
-            nn.Conv2d(self.state_dim[0], 16, 4, stride=4),
-            nn.LeakyReLU(),
-            nn.Conv2d(16, 32, 3, stride=2),
-            nn.LeakyReLU(),
-            nn.Conv2d(32, 64, 3, stride=2),
-        ]
+        return conv_layers(self.state_dim[0])
 
     def get_conv_out(self):
-        o = nn.Sequential(*self.hidden_layers())(torch.zeros(1, *self.state_dim))
-        return int(np.prod(o.size()))
+        return conv_out_size(self.fc_hidden, self.state_dim)
 
     def forward(self, x, actions=None):
         value = self.critic(x).squeeze(-1)
@@ -89,3 +161,149 @@ class ActorCritic(nn.Module):
 
     def state_values(self, states):
         return self.critic(states)
+
+    def rollout(self, x, actions, log_probs, values):
+        '''
+        Rollout inference: samples actions for x without building an autograd graph
+        and without computing entropy. The shared conv trunk runs once for both heads.
+
+        actions, log_probs, values - output buffers of shapes (N, act_size), (N,), (N,)
+        '''
+        n_hidden = len(self.fc_hidden)
+
+        with inference_mode():
+            hidden = self.actor[:n_hidden](x)
+            mu = self.actor[n_hidden:](hidden)
+            values.copy_(self.critic[n_hidden:](hidden).squeeze(-1))
+
+            std = self.log_std.exp().expand_as(mu)
+            torch.normal(mu, std, out=actions)
+            torch.sum(torch.distributions.Normal(mu, std).log_prob(actions), dim=-1, out=log_probs)
+
+        return actions, log_probs, values
+
+    def rollout_values(self, states, out=None):
+        '''
+        Bootstrap values for the rollout, without building an autograd graph. Shape (N,)
+        '''
+        with inference_mode():
+            values = self.critic(states).squeeze(-1)
+            if out is not None:
+                return out.copy_(values)
+
+        # inference tensors cannot take part in autograd later, hand out a normal one
+        return values.clone()
+
+class ActorStudent(nn.Module):
+    """
+    Compact actor-only network distilled from ActorCritic for serving.
+    Same (actions, log_prob, entropy, value) interface as ActorCritic, value is None.
+    """
+
+    def __init__(self, obs_size, act_size, width=128, depth=1, depthwise=False, model_path=None, map_location="cpu"):
+        '''
+        obs_size - (C, H, W) tuple of a visual observation
+        act_size - action space size
+        width - hidden units in each fully connected layer
+        depth - number of hidden fully connected layers
+        depthwise - use depthwise separable convolutions after the first one
+        model_path - checkpoint written by save(), or one already returned by load_checkpoint()
+        map_location - device the checkpoint tensors are loaded onto
+        '''
+        super().__init__()
+
+        self.action_dim = act_size
+        self.state_dim = list(obs_size)
+        self.width = width
+        self.depth = depth
+        self.depthwise = depthwise
+
+        checkpoint = model_path
+        if isinstance(model_path, str):
+            checkpoint = load_checkpoint(model_path, map_location)
+
+        self.fc_hidden = self.hidden_layers()
+
+        if checkpoint is not None:
+            conv_size = checkpoint["conv_size"]
+        else:
+            conv_size = conv_out_size(self.fc_hidden, self.state_dim)
+        self.conv_size = conv_size
+
+        fc = [Flatten()]
+        in_size = conv_size
+        for _ in range(depth):
+            fc += [nn.Linear(in_size, width), nn.Tanh()]
+            in_size = width
+        fc += [nn.Linear(in_size, act_size), nn.Tanh()]
+
+        self.actor = nn.Sequential(*self.fc_hidden, *fc)
+        self.log_std = nn.Parameter(torch.zeros(1, act_size))
+
+        if checkpoint is None:
+            self.actor.apply(xavier)
+        else:
+            self.load_state_dict(checkpoint["state_dict"])
+
+    def hidden_layers(self):
+        in_channels = self.state_dim[0]
+        if not self.depthwise:
+            return conv_layers(in_channels)
+
+        return [
+            nn.Conv2d(in_channels, 16, 4, stride=4),
+            nn.LeakyReLU(),
+            nn.Conv2d(16, 16, 3, stride=2, groups=16),
+            nn.Conv2d(16, 32, 1),
+            nn.LeakyReLU(),
+            nn.Conv2d(32, 32, 3, stride=2, groups=32),
+            nn.Conv2d(32, 64, 1),
+        ]
+
+    def save(self, path):
+        '''
+        Save weights together with the architecture needed to rebuild the network
+        '''
+        torch.save({
+            "state_dict": self.state_dict(),
+            "student": {"width": self.width, "depth": self.depth, "depthwise": self.depthwise},
+            "obs_size": self.state_dim,
+            "act_size": self.action_dim,
+            "conv_size": self.conv_size
+        }, path)
+
+    @classmethod
+    def from_checkpoint(cls, model_path, map_location="cpu"):
+        '''
+        Rebuild the student from a checkpoint path or one returned by load_checkpoint()
+        '''
+        checkpoint = model_path
+        if isinstance(model_path, str):
+            checkpoint = load_checkpoint(model_path, map_location)
+
+        return cls(checkpoint["obs_size"], checkpoint["act_size"], model_path=checkpoint, **checkpoint["student"])
+
+    def forward(self, x, actions=None):
+        mu = self.actor(x)
+
+        std = self.log_std.exp().expand_as(mu)
+        dist = torch.distributions.Normal(mu, std)
+
+        if actions is None:
+            actions = dist.sample()
+
+        log_prob = torch.sum(dist.log_prob(actions), dim=-1)
+        entropy = torch.sum(dist.entropy(), dim=-1)
+
+        return actions, log_prob, entropy, None
+
+def load_policy(model_path, obs_size=None, act_size=None, map_location="cpu"):
+    '''
+    Build ActorCritic or ActorStudent, whichever model_path was saved from.
+    obs_size and act_size are only needed for plain ActorCritic state dicts
+    '''
+    checkpoint = load_checkpoint(model_path, map_location)
+
+    if "student" in checkpoint:
+        return ActorStudent.from_checkpoint(checkpoint)
+    return ActorCritic.from_checkpoint(checkpoint, obs_size, act_size)
@@ -0,0 +1,198 @@
+import torch
+import numpy as np
+import copy
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+from model import load_policy
+
+from eval import open_env
+from trajectories import TrajectoryCollector
+from argparse import ArgumentParser
+
+NUM_CONSEQ_FRAMES = 6
+NUM_RUNS = 100
+NUM_ENVS = 8            # environments running side by side, one checkpoint each
+CONFIDENCE_Z = 1.96     # 95% confidence interval
+
+debug = False
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+class StackedPolicies:
+    """
+    N policies evaluated in one batched forward: actor weights are stacked
+    and the actor is vmap-ed over the leading (policy) dimension
+    """
+
+    def __init__(self, policies):
+        from torch.func import stack_module_state
+
+        self.params, self.buffers = stack_module_state([p.actor for p in policies])
+        self.log_std = torch.stack([p.log_std.detach() for p in policies])
+
+        # parameter-free copy of the actor to call with the stacked weights
+        self.base = copy.deepcopy(policies[0].actor).to("meta")
+
+    def __len__(self):
+        return self.log_std.shape[0]
+
+    def action_means(self, states):
+        from torch.func import functional_call, vmap
+
+        def actor(params, buffers, x):
+            return functional_call(self.base, (params, buffers), (x,))
+
+        return vmap(actor)(self.params, self.buffers, states)
+
+    def act(self, states):
+        '''
+        states - (N, G, C, H, W): a group of G observations for each of the N policies
+
+        Returns:
+        (N, G, A) actions sampled from each policy
+        '''
+        with torch.no_grad():
+            mu = self.action_means(states)
+            return torch.normal(mu, self.log_std.exp().expand_as(mu))
+
+def architecture(policy):
+    '''
+    Key telling apart actors that cannot be stacked together: teachers and the different students
+    '''
+    return tuple((name, tuple(p.shape)) for name, p in policy.actor.named_parameters())
+
+def leaderboard(checkpoints, scores):
+    '''
+    Rank checkpoints by mean episode score
+
+    Returns:
+    list of (checkpoint, mean, half width of the confidence interval, episodes), best first
+    '''
+    rows = []
+    for ckpt, s in zip(checkpoints, scores):
+        s = np.array(s)
+        ci = CONFIDENCE_Z * s.std(ddof=1) / np.sqrt(len(s)) if len(s) > 1 else np.inf
+        rows.append((ckpt, s.mean(), ci, len(s)))
+
+    return sorted(rows, key=lambda r: r[1], reverse=True)
+
+def play_round(trajectory_collectors, policies, num_runs, executor):
+    '''
+    Play num_runs episodes of each policy, policy i in environment i.
+    All policies act in one batched forward, then the environments step concurrently.
+    Every environment ends and scores its episodes on its own.
+
+    Returns:
+    list of per-episode scores (mean of summed agent rewards) for each policy
+    '''
+    n_policies = len(policies)
+    collectors = trajectory_collectors[:n_policies]
+
+    for c in collectors:
+        c.reset()
+
+    states = [c.last_states for c in collectors]
+    sum_rewards = np.zeros(n_policies)
+    scores = [[] for _ in range(n_policies)]
+
+    while any(len(s) < num_runs for s in scores):
+        # environments that are done still feed the forward, so its shape never changes
+        actions = policies.act(torch.stack(states)).cpu().numpy()
+
+        running = [i for i in range(n_policies) if len(scores[i]) < num_runs]
+        steps = {i: executor.submit(collectors[i].next_observation, actions[i]) for i in running}
+
+        for i in running:
+            next_states, rewards, dones = steps[i].result()
+            sum_rewards[i] += rewards.cpu().numpy().mean()
+            states[i] = next_states
+
+            if np.any(dones.cpu().numpy()):
+                collectors[i].reset()
+                states[i] = collectors[i].last_states
+
+                scores[i].append(sum_rewards[i])
+                sum_rewards[i] = 0
+                print(f"policy {i}: {len(scores[i])} of {num_runs}: total reward: {scores[i][-1]:.3f}")
+
+    return scores
+
+def add_arguments(parser):
+    parser.add_argument("-m", "--models", nargs="+", default=None, help="checkpoints to evaluate")
+    parser.add_argument("-d", "--ckpt_dir", default=None, help="evaluate all checkpoint_actor_*.pth in this directory")
+    parser.add_argument("-n", "--runs", type=int, default=NUM_RUNS, help="episodes per checkpoint")
+    parser.add_argument("-e", "--envs", type=int, default=NUM_ENVS, help="environments, and so checkpoints, played side by side")
+    parser.add_argument("-o", "--out_dir", default=None, help="output directory")
+
+def parse_args(argv=None):
+    parser = ArgumentParser()
+    add_arguments(parser)
+    return parser.parse_args(argv)
+
+def main(args):
+    import pandas as pd
+
+    # StackedPolicies needs torch.func: check before any unity environment starts
+    try:
+        import torch.func
+    except ImportError:
+        raise ImportError(f"tournament needs torch 2.0 or newer for torch.func, found torch {torch.__version__}") from None
+
+    checkpoints = list(args.models or [])
+    if args.ckpt_dir is not None:
+        checkpoints += sorted(glob.glob(os.path.join(args.ckpt_dir, "checkpoint_actor_*.pth")))
+    if len(checkpoints) == 0:
+        raise ValueError("no checkpoints to evaluate")
+
+    out_dir = args.out_dir
+    if out_dir is not None and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    # the editor is a single environment
+    n_envs = 1 if debug else min(args.envs, len(checkpoints))
+
+    envs = []
+    executor = ThreadPoolExecutor(max_workers=n_envs)
+    try:
+        trajectory_collectors = []
+        for i in range(n_envs):
+            env, num_agents, action_size, state_size = open_env(train_mode=False, worker_id=i, debug=debug)
+            envs.append(env)
+            trajectory_collectors.append(TrajectoryCollector(env, None, num_agents, is_visual=True, visual_state_size=NUM_CONSEQ_FRAMES, is_training=False))
+
+        # only actors of the same architecture stack into one forward
+        policies = [load_policy(p, state_size, action_size) for p in checkpoints]
+        groups = {}
+        for i, policy in enumerate(policies):
+            groups.setdefault(architecture(policy), []).append(i)
+
+        # each round plays as many checkpoints as there are environments
+        scores = [None] * len(checkpoints)
+        for group in groups.values():
+            for start in range(0, len(group), n_envs):
+                round_ids = group[start : start + n_envs]
+                print(f"Round of {len(round_ids)} checkpoints")
+
+                stacked = StackedPolicies([policies[i].to(device) for i in round_ids])
+
+                for i, s in zip(round_ids, play_round(trajectory_collectors, stacked, args.runs, executor)):
+                    scores[i] = s
+    finally:
+        executor.shutdown()
+        for env in envs:
+            env.close()
+
+    board = leaderboard(checkpoints, scores)
+
+    print("Leaderboard:")
+    for rank, (ckpt, mean, ci, n) in enumerate(board, 1):
+        print(f"{rank:3d}. {mean:.3f} +/- {ci:.3f} ({n} episodes) {os.path.basename(ckpt)}")
+
+    if out_dir is not None:
+        df = pd.DataFrame(board, columns=["checkpoint", "reward", "ci95", "episodes"], index=range(1, len(board) + 1))
+        df.to_csv(os.path.join(out_dir, r'leaderboard.csv'), index_label="rank")
+
+    return board
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -1,4 +1,5 @@
 import numpy as np
+import os
 
 import torch
 import numpy as np
@@ -15,6 +16,9 @@ class TrajectoryCollector:
             "values", "advantages", "returns"
         ]
 
+    # filled by policy.rollout(), in its argument order
+    inference_attrs = ["actions", "log_probs", "values"]
+
     def __init__(self, env, policy, num_agents, tmax=3, gamma = 0.99, gae_lambda = 0.96, is_visual = False, visual_state_size=1, debug = False, is_training=True):
         self.env = env
         self.policy = policy
@@ -38,6 +42,11 @@ class TrajectoryCollector:
 
         self.last_states = None
         self.is_training = is_training
+
+        # rollout in progress, see start_rollout()
+        self.buffer = None
+        self.inference = None
+
         self.reset()
 
     @staticmethod
@@ -47,10 +56,10 @@ class TrajectoryCollector:
     @staticmethod
     def get_agent_observations(env_info):
         '''
-        Retrieve all visual observations for all agents
+        Retrieve all visual observations for all agents: (N, H, W, C) from the first camera
         '''
 
-        obs = np.squeeze(np.array(env_info.visual_observations), axis=1)
+        obs = np.array(env_info.visual_observations[0])
         return TrajectoryCollector.to_tensor(obs)
 
     @staticmethod
@@ -119,6 +128,17 @@ class TrajectoryCollector:
             next_states = self.to_tensor(env_info.vector_observations)
         return next_states, rewards, dones
 
+    def allocate_inference_buffers(self, tmax=None):
+        '''
+        Per-step policy outputs for the whole rollout: (T, N, A) actions, (T, N) log probs and values
+        '''
+        tmax = self.tmax if tmax is None else tmax
+        return {
+            "actions": torch.zeros(tmax, self.num_agents, self.action_space_size, device=device),
+            "log_probs": torch.zeros(tmax, self.num_agents, device=device),
+            "values": torch.zeros(tmax, self.num_agents, device=device)
+        }
+
     def calc_returns(self, rewards, values, dones, last_values):
         n_step, n_agent = rewards.shape
 
@@ -149,66 +169,243 @@ class TrajectoryCollector:
 
         return GAE, returns
 
-    def create_trajectories(self):
-        """
-        Inspired by: https://github.com/tnakae/Udacity-DeepRL-p3-collab-compet/blob/master/PPO/agent.py
-        Creates trajectories and splites them between all agents, so each one gets individualized trajectories
+    def start_rollout(self, tmax=None):
+        '''
+        Fresh buffers for the next rollout of tmax steps (defaults to self.tmax)
+        '''
+        self.buffer = {k: [] for k in self.buffer_attrs}
+
+        # policy outputs are written in place, one row per step
+        self.inference = self.allocate_inference_buffers(tmax)
+        self.buffer.update(self.inference)
+
+    def act(self, t):
+        '''
+        Draw actions for step t of the rollout from the model
 
         Returns:
-        A list  of dictionaries, where each list contains a trajectory for its agent
-        """
+        actions to send to the environment
+        '''
+        self.policy.rollout(self.last_states, *[self.inference[k][t] for k in self.inference_attrs])
+        return self.inference["actions"][t].cpu().numpy()
 
-        buffer = {k: [] for k in self.buffer_attrs}
+    def observe(self, actions_np):
+        '''
+        One step forward with the actions returned by act(), recorded into the rollout buffers
+        '''
+        memory = {}
+        memory["states"] = self.last_states
+        memory["next_states"], memory["rewards"], memory["dones"] = self.next_observation(actions_np)
+
+        # stack one step memory to buffer
+        for k, v in memory.items():
+            self.buffer[k].append(v.unsqueeze(0))
+
+        self.last_states = memory["next_states"]
+        r = np.array(memory["rewards"].cpu().numpy())[None,:]
+        if self.rewards is None:
+            self.rewards = r
+        else:
+            self.rewards = np.r_[self.rewards, r]
 
-        for t in range(self.tmax):
-            memory = {}
-
-            # draw action from model
-            memory["states"] = self.last_states
-            pred = self.policy(memory["states"])
-            pred = [v.detach() for v in pred]
-            memory["actions"], memory["log_probs"], _, memory["values"] = pred
-
-            # one step forward
-            actions_np = memory["actions"].cpu().numpy()
-           
-            memory["next_states"], memory["rewards"], memory["dones"] = self.next_observation(actions_np)
-
-            # stack one step memory to buffer
-            for k, v in memory.items():
-                buffer[k].append(v.unsqueeze(0))
-
-            self.last_states = memory["next_states"]
-            r = np.array(memory["rewards"].cpu().numpy())[None,:]
-            if self.rewards is None:
-                self.rewards = r
-            else:
-                self.rewards = np.r_[self.rewards, r]
+        if memory["dones"].any():
+            rewards_mean = self.rewards.sum(axis=0).mean()
+            self.scores_by_episode.append(rewards_mean)
+            self.rewards = None
+            self.reset()
 
-            if memory["dones"].any():
-                rewards_mean = self.rewards.sum(axis=0).mean()
-                self.scores_by_episode.append(rewards_mean)
-                self.rewards = None
-                self.reset()
+    def finish_rollout(self, normalize=True):
+        '''
+        Compute returns and advantages of the rollout and flatten (T, N, ...) buffers to (T * N, ...)
+
+        normalize - normalize advantages. Callers merging several rollouts normalize them together instead
+        '''
+        buffer = self.buffer
+        self.buffer = self.inference = None
 
         # create tensors
         for k, v in buffer.items():
             # advantages and returns have not yet been computed
-            if len(v) > 0:
+            if isinstance(v, list) and len(v) > 0:
                 buffer[k] = torch.cat(v, dim=0)
 
         # append returns and advantages
-        values = self.policy.state_values(self.last_states).detach()
+        values = self.policy.rollout_values(self.last_states)
         advantages, buffer["returns"] = self.calc_returns(buffer["rewards"], buffer["values"], buffer["dones"], values)
-        buffer["advantages"] = (advantages - advantages.mean()) / (advantages.std() + 1e-10)
+        buffer["advantages"] = self.normalize_advantages(advantages) if normalize else advantages
 
         for k, v in buffer.items():
             # flatten everything.
             if len(v.shape) == 5: # images
-                buffer[k] = v.squeeze(1)
+                buffer[k] = v.reshape([-1] + list(v.shape[2:]))
             elif len(v.shape) == 3:
                 buffer[k] = v.reshape([-1, v.shape[-1]])
             else:
                 buffer[k] = v.reshape([-1])
 
-        return buffer    
+        return buffer
+
+    @staticmethod
+    def normalize_advantages(advantages):
+        return (advantages - advantages.mean()) / (advantages.std() + 1e-10)
+
+    def create_trajectories(self):
+        """
+        Inspired by: https://github.com/tnakae/Udacity-DeepRL-p3-collab-compet/blob/master/PPO/agent.py
+        Creates trajectories and splites them between all agents, so each one gets individualized trajectories
+
+        Returns:
+        A list  of dictionaries, where each list contains a trajectory for its agent
+        """
+
+        self.start_rollout()
+
+        for t in range(self.tmax):
+            self.observe(self.act(t))
+
+        return self.finish_rollout()
+
+    def stream_trajectories(self, chunk_size, normalize=True):
+        '''
+        Collect a tmax-step rollout as a sequence of chunks of at most chunk_size steps,
+        so only one chunk is held at a time. Each chunk's GAE is truncated at its end and bootstrapped
+        from the value of the state after its last step: with chunk_size == tmax this is create_trajectories().
+
+        normalize - normalize advantages per chunk. ChunkSpool normalizes over the whole rollout instead
+
+        Yields:
+        flattened chunk buffers, as returned by create_trajectories()
+        '''
+        for start in range(0, self.tmax, chunk_size):
+            n_steps = min(chunk_size, self.tmax - start)
+            self.start_rollout(n_steps)
+
+            for t in range(n_steps):
+                self.observe(self.act(t))
+
+            yield self.finish_rollout(normalize=normalize)
+
+class ChunkSpool:
+    """
+    Bounded store for the chunks of one streamed rollout: the first max_chunks stay in memory,
+    the rest are spilled to spill_dir. Advantages are normalized over all chunks when read back,
+    as create_trajectories() normalizes them over the whole rollout.
+    """
+
+    def __init__(self, spill_dir, max_chunks=1):
+        self.spill_dir = spill_dir
+        self.max_chunks = max_chunks
+
+        if not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+
+        self.chunks = []
+        self.n_samples = 0
+        self.adv_sum = 0.
+        self.adv_sq_sum = 0.
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def put(self, chunk):
+        '''
+        chunk - flattened buffers with unnormalized advantages
+        '''
+        advantages = chunk["advantages"].double()
+        self.n_samples += advantages.shape[0]
+        self.adv_sum += advantages.sum().item()
+        self.adv_sq_sum += (advantages ** 2).sum().item()
+
+        if len(self.chunks) < self.max_chunks:
+            self.chunks.append(chunk)
+            return
+
+        path = os.path.join(self.spill_dir, f"chunk_{len(self.chunks)}.pth")
+        torch.save(chunk, path)
+        self.chunks.append(path)
+
+    def advantage_stats(self):
+        mean = self.adv_sum / self.n_samples
+        var = (self.adv_sq_sum - self.n_samples * mean ** 2) / max(self.n_samples - 1, 1)
+        return mean, max(var, 0.) ** 0.5
+
+    def __iter__(self):
+        '''
+        Yields chunks in order, spilled ones are loaded back one at a time.
+        Every pass reads all spilled chunks from disk: run the epochs over a chunk, not over the spool
+        '''
+        mean, std = self.advantage_stats()
+
+        for chunk in self.chunks:
+            if isinstance(chunk, str):
+                chunk = torch.load(chunk, map_location=device)
+
+            chunk = dict(chunk)
+            chunk["advantages"] = (chunk["advantages"] - mean) / (std + 1e-10)
+            yield chunk
+
+    def clear(self):
+        for chunk in self.chunks:
+            if isinstance(chunk, str):
+                os.remove(chunk)
+
+        self.chunks = []
+        self.n_samples = 0
+        self.adv_sum = self.adv_sq_sum = 0.
+
+class PipelinedTrajectoryCollector:
+    """
+    Double-buffered collection over two groups of agents, each with its own environment:
+    the policy runs inference for one group while the other group's env step is in flight, then they swap.
+    Each group keeps its own episodes and GAE, rollouts are merged at the end.
+    """
+
+    def __init__(self, collectors):
+        '''
+        collectors - two TrajectoryCollector objects sharing the policy, each over its own environment
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+
+        assert len(collectors) == 2
+        self.collectors = collectors
+        self.tmax = collectors[0].tmax
+
+        # env steps block on unity (socket I/O), so a thread overlaps them with inference
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.scores_by_episode = []
+        self.n_scores = [0] * len(collectors)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def create_trajectories(self):
+        '''
+        Same output as TrajectoryCollector.create_trajectories(): the two groups' rollouts concatenated
+        '''
+        a, b = self.collectors
+        for c in self.collectors:
+            c.start_rollout()
+
+        step_a = self.executor.submit(a.observe, a.act(0))
+        for t in range(self.tmax):
+            actions_b = b.act(t)
+            step_a.result()
+
+            step_b = self.executor.submit(b.observe, actions_b)
+            if t + 1 < self.tmax:
+                actions_a = a.act(t + 1)
+            step_b.result()
+
+            if t + 1 < self.tmax:
+                step_a = self.executor.submit(a.observe, actions_a)
+
+        rollouts = [c.finish_rollout(normalize=False) for c in self.collectors]
+        buffer = {k: torch.cat([r[k] for r in rollouts], dim=0) for k in rollouts[0]}
+        buffer["advantages"] = TrajectoryCollector.normalize_advantages(buffer["advantages"])
+
+        for i, c in enumerate(self.collectors):
+            self.scores_by_episode += c.scores_by_episode[self.n_scores[i] : ]
+            self.n_scores[i] = len(c.scores_by_episode)
+
+        return buffer